@@ -9,7 +9,9 @@
 # generation in the output because we can use relative paths there and not
 # have to know about the other URLs they're available at.
 #
-# This program requires the dirhasher[2] program to be installed.
+# Archive hashes are computed in-process with the same algorithm as the
+# dirhasher[2] program; pass --external-hasher to shell out to an installed
+# dirhasher binary instead.
 #
 # During copying, if a mirror object exists for an archive that would be copied,
 # and that mirror object has a dirhash metadata header, that dirhash value
@@ -55,24 +57,60 @@
 # [1] https://www.terraform.io/docs/internals/provider-network-mirror-protocol.html
 # [2] https://github.com/arpio/dirhasher
 
+import argparse
+import fcntl
+import hashlib
+import io
 import json
+import os
+import re
 import subprocess
 import sys
 import tempfile
-from collections import defaultdict
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import groupby
 from typing import Tuple, NamedTuple, Optional
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DIRHASH_METADATA = 'dirhash'
 """Custom S3 metadata header we set so we can avoid uploading the archive if it's already current."""
 
+COPY_OBJECT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+"""Largest object a single CopyObject request can handle; bigger needs multipart copy."""
+
+IN_MEMORY_MAX_SIZE = 512 * 1024 * 1024
+"""Archives up to this size are hashed from memory instead of being staged on disk."""
+
+ZIP_TAIL_BYTES = 1 << 20
+"""How much of a zip's tail to fetch when reading just its central directory."""
+
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True,
+)
+"""Transfer settings that let a single large archive copy in parallel parts."""
+
 
 class MirrorError(Exception):
     pass
 
 
+_ARCHIVE_RE = re.compile(r'(?:.*/)?([^/_]+)_([^/_]+)_([^/_]+)_([^/]+)\.zip')
+"""Matches {prefix}/{provider}_{version}_{os}_{arch}.zip; the arch may contain underscores."""
+
+
 class Archive(NamedTuple):
     key: str
     file_name: str
@@ -83,22 +121,17 @@ class Archive(NamedTuple):
 
     @classmethod
     def parse(cls, key: str) -> Optional['Archive']:
-        file_name = key.split('/')[-1]
-        if not file_name.endswith('.zip'):
-            return None
-
-        without_ext = file_name[:-4]
-        parts = without_ext.split('_', 3)
-        if len(parts) != 4 or any(p == '' for p in parts):
+        m = _ARCHIVE_RE.fullmatch(key)
+        if not m:
             return None
 
         return Archive(
             key=key,
-            file_name=file_name,
-            provider=parts[0],
-            version=parts[1],
-            os=parts[2],
-            arch=parts[3],
+            file_name=key[m.start(1):],
+            provider=m.group(1),
+            version=m.group(2),
+            os=m.group(3),
+            arch=m.group(4),
         )
 
 
@@ -117,127 +150,470 @@ def check_bucket_access(bucket_name: str) -> None:
         raise MirrorError(f'Cannot access bucket {bucket_name}: {e}')
 
 
+CACHE_PATH = os.path.expanduser('~/.cache/terraform-mirror-dirhash.json')
+"""Where dirhash results are persisted so re-runs don't re-download and re-hash unchanged archives."""
+
+_external_hasher = False
+"""Set from --external-hasher to shell out to dirhasher instead of hashing in-process."""
+
+_fast_hash = False
+"""Set from --fast-hash to hash central-directory CRCs instead of decompressed contents."""
+
+_dirhash_cache = {}
+"""Dirhash results keyed by source object identity, loaded from and saved to CACHE_PATH."""
+
+_hash_pool: Optional[ProcessPoolExecutor] = None
+"""Process pool for in-process hashing, so the GIL doesn't serialize CPU-bound hash work."""
+
+_hash_buffers = threading.local()
+"""Per-thread read buffer reused across archives so each hash doesn't reallocate 1 MiB."""
+
+
+def dirhash_file(archive) -> str:
+    """Hash a zip archive's member names and contents, in sorted member order.
+
+    Takes anything zipfile.ZipFile accepts: a path or a seekable file object.
+    """
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None:
+        buf = _hash_buffers.buf = bytearray(1 << 20)
+    view = memoryview(buf)
+
+    h = hashlib.blake2b(digest_size=32)
+    with zipfile.ZipFile(archive) as zf:
+        for name in sorted(zf.namelist()):
+            h.update(name.encode())
+            with zf.open(name) as f:
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    h.update(view[:n])
+    return h.hexdigest()
+
+
+def dirhash_bytes(data: bytes) -> str:
+    """dirhash_file over in-memory archive bytes; top-level so it crosses the process pool."""
+    return dirhash_file(io.BytesIO(data))
+
+
+def dirhash_fast(archive) -> str:
+    """Hash each zip member's name, CRC32, and size from the central directory.
+
+    Reads only the central directory (a few KB) instead of decompressing every
+    member.  The result is deterministic and detects content changes, but it's
+    a different value than the full dirhash, so mirrors built with it must
+    always be refreshed with --fast-hash.
+    """
+    h = hashlib.blake2b(digest_size=32)
+    with zipfile.ZipFile(archive) as zf:
+        for zi in sorted(zf.infolist(), key=lambda z: z.filename):
+            h.update(f'{zi.filename}\0{zi.CRC:08x}\0{zi.file_size}\n'.encode())
+    return h.hexdigest()
+
+
+class ZipTail(io.RawIOBase):
+    """Seekable view of a zip whose bytes are only present from `start` to EOF.
+
+    Enough for zipfile to find the end-of-central-directory record and read
+    the central directory; member data below `start` was never fetched, so
+    reading it is an error.
+    """
+
+    def __init__(self, data: bytes, start: int, size: int):
+        self._data = data
+        self._start = start
+        self._size = size
+        self._pos = start
+
+    def seekable(self) -> bool:
+        return True
+
+    def readable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        if self._pos < self._start:
+            raise MirrorError(f'read at {self._pos} is below the fetched zip tail at {self._start}')
+        rel = self._pos - self._start
+        data = self._data[rel:] if n < 0 else self._data[rel:rel + n]
+        self._pos += len(data)
+        return data
+
+
+def dirhash_fast_remote(obj: 's3.Object') -> str:
+    """Compute the fast hash from ranged GETs of just the zip's central directory."""
+    size = obj.content_length
+    tail_start = max(0, size - ZIP_TAIL_BYTES)
+    tail = obj.get(Range=f'bytes={tail_start}-')['Body'].read()
+
+    if tail_start > 0:
+        # If the central directory starts before the fetched tail, pull the rest
+        eocd = tail.rfind(b'PK\x05\x06')
+        if eocd < 0:
+            raise MirrorError(f'No end-of-central-directory in the last {len(tail)} bytes of {obj.key}')
+        cd_offset = int.from_bytes(tail[eocd + 16:eocd + 20], 'little')
+        if cd_offset < tail_start:
+            rest = obj.get(Range=f'bytes={cd_offset}-{tail_start - 1}')['Body'].read()
+            tail = rest + tail
+            tail_start = cd_offset
+
+    return dirhash_fast(ZipTail(tail, tail_start, size))
+
+
+def dirhash_external(path: str) -> str:
+    p = subprocess.run(['dirhasher', path], capture_output=True)
+    if p.returncode != 0:
+        raise MirrorError(f'dirhasher failed with code: {p.returncode}')
+    return str(p.stdout, 'utf-8').strip()
+
+
+def stream_to(obj: 's3.Object', sink) -> str:
+    """Stream the object into sink in 1 MiB chunks, returning the raw content digest."""
+    raw = hashlib.blake2b(digest_size=32)
+    body = obj.get()['Body']
+    for chunk in iter(lambda: body.read(1 << 20), b''):
+        sink.write(chunk)
+        raw.update(chunk)
+    return raw.hexdigest()
+
+
 def dirhash(obj: 's3.Object') -> str:
-    with tempfile.NamedTemporaryFile() as tf:
-        obj.download_file(tf.name)
-        p = subprocess.run(['dirhasher', tf.name], capture_output=True)
-        if p.returncode != 0:
-            raise MirrorError(f'dirhasher failed with code: {p.returncode}')
-        return str(p.stdout, 'utf-8').strip()
+    # The fast hash only needs the central directory, so fetch just that with
+    # ranged GETs and never materialize the archive at all
+    if _fast_hash:
+        return dirhash_fast_remote(obj)
+
+    # The full hash needs random access into the whole zip.  Buffer reasonably
+    # sized archives in memory; disk staging remains for huge archives and for
+    # the external hasher, which wants a real file.  Either way the raw bytes
+    # are hashed in the same loop that stores them, and that content hash can
+    # skip the zip-member hashing entirely (including when a re-uploaded
+    # archive has identical content but a different ETag).
+    on_disk = _external_hasher or obj.content_length > IN_MEMORY_MAX_SIZE
+    with tempfile.NamedTemporaryFile() if on_disk else io.BytesIO() as sink:
+        raw_hex = stream_to(obj, sink)
+        if on_disk:
+            sink.flush()
+        raw_key = f'raw:{hash_mode()}:{raw_hex}'
+        h1 = _dirhash_cache.get(raw_key)
+        if h1 is None:
+            if _external_hasher:
+                h1 = dirhash_external(sink.name)
+            elif _hash_pool is None:
+                h1 = dirhash_file(sink.name if on_disk else sink)
+            elif on_disk:
+                # Hand the CPU-bound decompress+hash to a worker process so
+                # downloader threads aren't serialized on the GIL; only the
+                # path crosses the process boundary
+                h1 = _hash_pool.submit(dirhash_file, sink.name).result()
+            else:
+                # In-memory archives ship their bytes to the worker process -
+                # a pipe copy, but still cheaper than a disk round-trip
+                h1 = _hash_pool.submit(dirhash_bytes, sink.getvalue()).result()
+            _dirhash_cache[raw_key] = h1
+        return h1
+
+
+def hash_mode() -> str:
+    if _external_hasher:
+        return 'dirhasher'
+    if _fast_hash:
+        return 'crc32'
+    return 'blake2b'
+
+
+def cache_key(obj: 's3.Object') -> str:
+    # The ETag pins the exact content that was hashed, and the hasher mode
+    # matters because the hashers produce different values.
+    return f'{hash_mode()}:{obj.bucket_name}/{obj.key}@{obj.e_tag}'
 
 
-def object_exists(obj: 's3.Object') -> bool:
+def load_cache() -> dict:
     try:
-        obj.load()
-        return True
+        with open(CACHE_PATH) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache: dict) -> None:
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            merged = json.load(f)
+        except ValueError:
+            merged = {}
+        merged.update(cache)
+        f.seek(0)
+        f.truncate()
+        json.dump(merged, f)
+
+
+def list_existing(client, bucket_name: str, prefix: str) -> dict:
+    """List every object under the prefix once, instead of HEADing keys one by one."""
+    paginator = client.get_paginator('list_objects_v2')
+    return {o['Key']: o
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+            for o in page.get('Contents', [])}
+
+
+def dumps_json(data: dict) -> bytes:
+    """Serialize metadata JSON with orjson when it's available, stdlib json otherwise."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2)
+    return bytes(json.dumps(data, sort_keys=True, indent=2), 'utf-8')
+
+
+def json_unchanged(existing: dict, key: str, body: bytes) -> bool:
+    """True if the stored object's ETag shows it already holds exactly this body.
+
+    S3 returns the quoted MD5 of the content as the ETag for single-part PUTs,
+    which these small metadata JSONs always are.
+    """
+    obj = existing.get(key)
+    return obj is not None and obj.get('ETag') == '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+def head_metadata(client, bucket_name: str, key: str) -> Optional[dict]:
+    """Fetch an object's user metadata with a single HEAD, or None if it doesn't exist."""
+    try:
+        return client.head_object(Bucket=bucket_name, Key=key)['Metadata']
     except ClientError as e:
         if e.response['Error']['Code'] == '404':
-            return False
+            return None
         raise
 
 
-def copy_archive(rel_obj: 's3.Object', mirror_obj: 's3.Object') -> Tuple[str, bool]:
-    # We can skip the copy if the mirror object exists and has a dirhash
-    if object_exists(mirror_obj) and mirror_obj.metadata.get(DIRHASH_METADATA):
-        return mirror_obj.metadata[DIRHASH_METADATA], False
-
-    # Compute the dirhash of the release archive
-    h1 = dirhash(rel_obj)
-
-    # Copy the archive to the mirror if it's not already there with the correct hash
+def fetch_existing_metadata(client, bucket_name: str, existing: dict, workers: int) -> dict:
+    """HEAD every existing mirror archive concurrently, up front.
+
+    LIST doesn't return user metadata, so the dirhash still costs a HEAD per
+    existing key; doing them all here in one parallel phase keeps that latency
+    off the per-archive critical path.
+    """
+    zip_keys = [k for k in existing if k.endswith('.zip')]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(pool.map(lambda k: (k, head_metadata(client, bucket_name, k)), zip_keys))
+
+
+def copy_archive(rel_obj: 's3.Object', mirror_obj: 's3.Object', existing_meta: dict) -> Tuple[str, bool]:
+    # We can skip the copy if the mirror object exists and has a dirhash;
+    # the pre-fetched metadata makes this a pure dict lookup
+    metadata = existing_meta.get(mirror_obj.key)
+    if metadata and metadata.get(DIRHASH_METADATA):
+        return metadata[DIRHASH_METADATA], False
+
+    # Compute the dirhash of the release archive, reusing a cached result
+    # from a previous run when the release object hasn't changed
+    key = cache_key(rel_obj)
+    h1 = _dirhash_cache.get(key)
+    if h1 is None:
+        h1 = dirhash(rel_obj)
+        _dirhash_cache[key] = h1
+
+    # Copy the archive to the mirror if it's not already there with the correct hash.
+    # A server-side CopyObject is a single request with no client-side data
+    # movement, so prefer it; only objects past its 5 GB limit need the
+    # managed multipart copy.
     metadata = dict(rel_obj.metadata)
     metadata[DIRHASH_METADATA] = h1
-    mirror_obj.copy_from(
-        CopySource={
-            'Bucket': rel_obj.bucket_name,
-            'Key': rel_obj.key,
-        },
-        Metadata=metadata,
-        MetadataDirective='REPLACE'
-    )
+    copy_source = {
+        'Bucket': rel_obj.bucket_name,
+        'Key': rel_obj.key,
+    }
+    if rel_obj.content_length <= COPY_OBJECT_MAX_SIZE:
+        mirror_obj.meta.client.copy_object(
+            Bucket=mirror_obj.bucket_name,
+            Key=mirror_obj.key,
+            CopySource=copy_source,
+            Metadata=metadata,
+            MetadataDirective='REPLACE',
+        )
+    else:
+        mirror_obj.copy(
+            CopySource=copy_source,
+            ExtraArgs={
+                'Metadata': metadata,
+                'MetadataDirective': 'REPLACE',
+            },
+            Config=TRANSFER_CFG,
+        )
     return h1, True
 
 
+def process_archive(archive: Archive, rel_bucket: 's3.Bucket', mirror_bucket: 's3.Bucket',
+                    out_prefix: str, existing_meta: dict) -> Tuple[Archive, 's3.Object', str, bool]:
+    rel_obj = rel_bucket.Object(archive.key)
+    mirror_obj = mirror_bucket.Object(f'{out_prefix}{archive.version}/{archive.file_name}')
+    h1, copied = copy_archive(rel_obj, mirror_obj, existing_meta)
+    return archive, mirror_obj, h1, copied
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Generate a Terraform provider network mirror from binary release archives.')
+    parser.add_argument('releases', metavar='input-releases-bucket/prefix')
+    parser.add_argument('mirror', metavar='output-mirror-bucket/prefix')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='number of archives to process concurrently (default: 16)')
+    parser.add_argument('--since-version', metavar='VERSION',
+                        help='start the releases listing at this version instead of scanning '
+                             'the whole prefix; assumes {prefix}{version}/... key layout and '
+                             'lexicographic version order')
+    hasher = parser.add_mutually_exclusive_group()
+    hasher.add_argument('--external-hasher', action='store_true',
+                        help='hash archives with the dirhasher program instead of in-process')
+    hasher.add_argument('--fast-hash', action='store_true',
+                        help='hash zip central-directory CRCs instead of decompressed contents '
+                             '(faster, but not compatible with mirrors built with the full hash)')
+    return parser.parse_args()
+
+
 def main() -> None:
-    if len(sys.argv) != 3:
-        raise MirrorError(f'usage: {sys.argv[0]} input-releases-bucket/prefix output-mirror-bucket/prefix')
+    global _external_hasher, _fast_hash, _hash_pool
+
+    args = parse_args()
+    _external_hasher = args.external_hasher
+    _fast_hash = args.fast_hash
+    if not _external_hasher and not _fast_hash:
+        _hash_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
 
-    rel_bucket_name, rel_prefix = parse_bucket_and_prefix(sys.argv[1])
-    mirror_bucket_name, out_prefix = parse_bucket_and_prefix(sys.argv[2])
+    rel_bucket_name, rel_prefix = parse_bucket_and_prefix(args.releases)
+    mirror_bucket_name, out_prefix = parse_bucket_and_prefix(args.mirror)
 
     s3 = boto3.resource('s3')
+    client = s3.meta.client
     check_bucket_access(rel_bucket_name)
     check_bucket_access(mirror_bucket_name)
 
+    _dirhash_cache.update(load_cache())
+
+    # One paginated LIST of the mirror prefix replaces a HEAD per key, and the
+    # dirhash metadata for the keys that do exist is fetched in one parallel
+    # pass so the per-archive path never waits on a HEAD
+    existing = list_existing(client, mirror_bucket_name, out_prefix)
+    existing_meta = fetch_existing_metadata(client, mirror_bucket_name, existing, args.workers)
+
     rel_bucket = s3.Bucket(rel_bucket_name)
     mirror_bucket = s3.Bucket(mirror_bucket_name)
 
-    # Gather all the released archives
-    provider_versions = defaultdict(lambda: defaultdict(set))
-    for rel_obj in rel_bucket.objects.filter(Prefix=rel_prefix):
-        archive = Archive.parse(rel_obj.key)
-        if archive:
-            provider_versions[archive.provider][archive.version].add(archive)
-
-    for provider in sorted(provider_versions):
-        print(f'{provider}')
-        versions = provider_versions[provider]
-
-        copied_any_this_provider = False
-        index_data = {'versions': {}}
-        for version in sorted(versions):
-            print(f' {version}')
-            archives = versions[version]
-
-            copied_any_this_version = False
-            version_data = {'archives': {}}
-            for archive in sorted(archives):
-                rel_obj = rel_bucket.Object(archive.key)
-                mirror_obj = mirror_bucket.Object(f'{out_prefix}{archive.version}/{archive.file_name}')
-
-                h1, copied = copy_archive(rel_obj, mirror_obj)
-                if copied:
-                    copied_any_this_version = True
-                    copy_status = '+'
+    # Gather all the released archives.  With --since-version the LIST starts
+    # just below that version's keys, so the scan cost tracks new content
+    # instead of the full history of the prefix.
+    filter_kwargs = {'Prefix': rel_prefix}
+    if args.since_version:
+        filter_kwargs['Marker'] = f'{rel_prefix}{args.since_version}'
+
+    archives = [a for a in map(Archive.parse, (o.key for o in rel_bucket.objects.filter(**filter_kwargs))) if a]
+    archives = list({(a.provider, a.version, a.os, a.arch): a for a in archives}.values())
+    archives.sort(key=lambda a: (a.provider, a.version, a.os, a.arch))
+
+    # The per-archive work (HEAD, hash, copy) is I/O-bound and independent
+    # across archives, so fan it out on a thread pool shared by all providers.
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for provider, provider_archives in groupby(archives, key=lambda a: a.provider):
+            print(f'{provider}')
+            versions = {version: list(group)
+                        for version, group in groupby(provider_archives, key=lambda a: a.version)}
+
+            # Submit every archive of every version up front: archives are
+            # independent of each other, so a slow version shouldn't hold up
+            # the work queued behind it.  Only the version.json depends on
+            # its archives, and the index.json on all of the versions.
+            futures = {
+                version: [executor.submit(process_archive, a, rel_bucket, mirror_bucket,
+                                          out_prefix, existing_meta)
+                          for a in versions[version]]
+                for version in versions
+            }
+
+            index_data = {'versions': {version: {} for version in versions}}
+
+            # A narrowed listing only saw versions at or above the marker, so
+            # seed the index with the versions already in the mirror rather
+            # than clobbering them
+            if args.since_version and f'{out_prefix}index.json' in existing:
+                current = mirror_bucket.Object(f'{out_prefix}index.json').get()
+                for version in json.loads(current['Body'].read()).get('versions', {}):
+                    index_data['versions'].setdefault(version, {})
+
+            # Submit each version.json the moment its last archive finishes,
+            # while other versions are still hashing: count down remaining
+            # archives per version as futures complete and queue the put at
+            # zero.  Only the index.json waits for everything.
+            future_version = {f: version for version, fs in futures.items() for f in fs}
+            remaining = {version: len(fs) for version, fs in futures.items()}
+            version_status = {}
+            put_futures = []
+            for f in as_completed(future_version):
+                version = future_version[f]
+                remaining[version] -= 1
+                if remaining[version] > 0:
+                    continue
+
+                # Construct the version file entries with relative urls; the
+                # futures list keeps the deterministic (os, arch) order
+                version_data = {'archives': {}}
+                for archive, mirror_obj, h1, copied in (vf.result() for vf in futures[version]):
+                    os_arch = f'{archive.os}_{archive.arch}'
+                    version_data['archives'][os_arch] = {
+                        'hashes': [h1],
+                        'url': f'{archive.version}/{archive.file_name}',
+                    }
+
+                # Put the version JSON unless the mirror already holds this exact body
+                version_key = f'{out_prefix}{version}.json'
+                version_body = dumps_json(version_data)
+                if not json_unchanged(existing, version_key, version_body):
+                    put_futures.append(executor.submit(
+                        client.put_object, Bucket=mirror_bucket_name, Key=version_key,
+                        Body=version_body, ContentType='application/json'))
+                    version_status[version] = '+'
                 else:
-                    copy_status = '='
-                print(f'  {copy_status} {mirror_obj.bucket_name}/{mirror_obj.key} {h1}')
-
-                # Construct the entry for the version file with a relative url
-                os_arch = f'{archive.os}_{archive.arch}'
-                version_data['archives'][os_arch] = {
-                    'hashes': [h1],
-                    'url': f'{archive.version}/{archive.file_name}',
-                }
-
-            # Put a version JSON if we copied archives for this version
-            version_obj = mirror_bucket.Object(f'{out_prefix}{version}.json')
-            if copied_any_this_version or not object_exists(version_obj):
-                version_obj.put(
-                    Body=bytes(json.dumps(version_data, sort_keys=True, indent=2), 'utf-8'),
-                    ContentType='application/json',
-                )
-                copied_any_this_provider = True
+                    version_status[version] = '='
+
+            # Report in version order now that everything has settled
+            for version in versions:
+                print(f' {version}')
+                for archive, mirror_obj, h1, copied in (vf.result() for vf in futures[version]):
+                    copy_status = '+' if copied else '='
+                    print(f'  {copy_status} {mirror_obj.bucket_name}/{mirror_obj.key} {h1}')
+                print(f'  {version_status[version]} {mirror_bucket_name}/{out_prefix}{version}.json')
+
+            # The index must land after every version JSON it points at
+            for pf in put_futures:
+                pf.result()
+
+            index_key = f'{out_prefix}index.json'
+            index_body = dumps_json(index_data)
+            if not json_unchanged(existing, index_key, index_body):
+                client.put_object(Bucket=mirror_bucket_name, Key=index_key,
+                                  Body=index_body, ContentType='application/json')
                 copy_status = '+'
             else:
                 copy_status = '='
-            print(f'  {copy_status} {version_obj.bucket_name}/{version_obj.key}')
-
-            # Add an entry for this version to the index
-            index_data['versions'][version] = {}
-
-        # Put the index JSON if we copied any archives for the provider
-        index_obj = mirror_bucket.Object(f'{out_prefix}index.json')
-        if copied_any_this_provider or not object_exists(index_obj):
-            index_obj.put(
-                Body=bytes(json.dumps(index_data, sort_keys=True, indent=2), 'utf-8'),
-                ContentType='application/json',
-            )
-            copy_status = '+'
-        else:
-            copy_status = '='
-        print(f' *')
-        print(f'  {copy_status} {index_obj.bucket_name}/{index_obj.key}')
+            print(f' *')
+            print(f'  {copy_status} {mirror_bucket_name}/{index_key}')
+
+    if _hash_pool is not None:
+        _hash_pool.shutdown()
+    save_cache(_dirhash_cache)
 
 
 if __name__ == '__main__':